@@ -1,10 +1,16 @@
 import asyncio
+import hashlib
 import json
+import logging
+import marshal
+import mmap
 import os
 import random
 import re
 import sqlite3
 import string
+import struct
+import sys
 import time
 from dataclasses import dataclass, field
 from pathlib import Path
@@ -15,43 +21,60 @@ from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, PlainTex
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
+try:
+    import msgpack
+except ImportError:  # без msgpack сервер говорит только JSON
+    msgpack = None
+
 APP_DIR = Path(__file__).parent.resolve()
 DATA_DIR = APP_DIR / "data"
 STATIC_DIR = APP_DIR / "static"
 DB_PATH = APP_DIR / "sonp.sqlite3"
+ARCHIVE_DB_PATH = APP_DIR / "sonp_archive.sqlite3"
 TASKS_PATH = DATA_DIR / "tasks.json"
+TASKS_BANK_PATH = DATA_DIR / "tasks.bank"
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(STATIC_DIR, exist_ok=True)
 
+# Завершённые комнаты старше этого срока переносятся в архивную базу
+ARCHIVE_AFTER_DAYS = int(os.environ.get("SONP_ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL_S = 6 * 3600
+ARCHIVE_BATCH = 200           # комнат за одну транзакцию переноса
+ARCHIVE_BATCH_PAUSE_S = 0.05  # пауза между пачками, чтобы игровые записи успевали взять блокировку
+
+log = logging.getLogger(__name__)
+
 # ====================== DB ======================
-def _has_column(cur: sqlite3.Cursor, table: str, column: str) -> bool:
-    cur.execute(f"PRAGMA table_info('{table}')")
+ROOM_COLUMNS = "code, created_at, rounds, status, scoring"
+PLAYER_COLUMNS = "room_code, player_id, name, score, time_ms"
+ANSWER_COLUMNS = ("room_code, round_no, question_id, category, player_id, player_name, "
+                  "answer_text, answer_choice, is_correct, awarded, time_spent_ms")
+
+def _has_column(cur: sqlite3.Cursor, table: str, column: str, schema: str = "main") -> bool:
+    cur.execute(f"PRAGMA {schema}.table_info('{table}')")
     cols = {row[1] for row in cur.fetchall()}
     return column in cols
 
-def db_init():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS rooms(
+def _create_tables(cur: sqlite3.Cursor, schema: str = "main"):
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.rooms(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         code TEXT UNIQUE,
         created_at INTEGER,
         rounds INTEGER,
         status TEXT
     )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS players(
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.players(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         room_code TEXT,
         player_id TEXT,
         name TEXT,
         score INTEGER DEFAULT 0
     )""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS answers(
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.answers(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         room_code TEXT,
         round_no INTEGER,
@@ -65,45 +88,88 @@ def db_init():
         time_spent_ms INTEGER
     )""")
 
-    if not _has_column(cur, "players", "score"):
-        cur.execute("ALTER TABLE players ADD COLUMN score INTEGER DEFAULT 0")
+    if not _has_column(cur, "players", "score", schema):
+        cur.execute(f"ALTER TABLE {schema}.players ADD COLUMN score INTEGER DEFAULT 0")
 
-    if not _has_column(cur, "rooms", "status"):
-        cur.execute("ALTER TABLE rooms ADD COLUMN status TEXT")
+    if not _has_column(cur, "rooms", "status", schema):
+        cur.execute(f"ALTER TABLE {schema}.rooms ADD COLUMN status TEXT")
 
-    if not _has_column(cur, "answers", "answer_choice"):
-        cur.execute("ALTER TABLE answers ADD COLUMN answer_choice INTEGER")
+    if not _has_column(cur, "rooms", "scoring", schema):
+        cur.execute(f"ALTER TABLE {schema}.rooms ADD COLUMN scoring TEXT DEFAULT 'classic'")
 
-    if not _has_column(cur, "answers", "time_spent_ms"):
-        cur.execute("ALTER TABLE answers ADD COLUMN time_spent_ms INTEGER")
+    if not _has_column(cur, "players", "time_ms", schema):
+        cur.execute(f"ALTER TABLE {schema}.players ADD COLUMN time_ms INTEGER DEFAULT 0")
 
+    if not _has_column(cur, "answers", "answer_choice", schema):
+        cur.execute(f"ALTER TABLE {schema}.answers ADD COLUMN answer_choice INTEGER")
+
+    if not _has_column(cur, "answers", "time_spent_ms", schema):
+        cur.execute(f"ALTER TABLE {schema}.answers ADD COLUMN time_spent_ms INTEGER")
+
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_players_room ON players(room_code)")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_answers_room ON answers(room_code)")
+
+def db_init():
+    con = sqlite3.connect(DB_PATH)
+    cur = con.cursor()
+    _create_tables(cur)
+
+    # Агрегаты по вопросам для адаптивной сложности. Хранятся только в рабочей
+    # базе и не переносятся в архив; при первом создании заполняются из истории.
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='question_stats'")
+    if not cur.fetchone():
+        cur.execute("""
+        CREATE TABLE question_stats(
+            question_id TEXT PRIMARY KEY,
+            correct INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0
+        )""")
+        source = "main.answers"
+        if ARCHIVE_DB_PATH.exists():
+            cur.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+            source = """(SELECT question_id, is_correct FROM main.answers
+                         UNION ALL
+                         SELECT question_id, is_correct FROM archive.answers)"""
+        cur.execute(f"""
+            INSERT INTO question_stats(question_id, correct, total)
+            SELECT question_id, SUM(is_correct), COUNT(*) FROM {source}
+            WHERE question_id IS NOT NULL
+            GROUP BY question_id
+        """)
     con.commit()
+
+    # incremental_vacuum работает только при auto_vacuum=INCREMENTAL;
+    # для существующей базы режим включается полным VACUUM один раз.
+    cur.execute("PRAGMA auto_vacuum")
+    if cur.fetchone()[0] != 2:
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("VACUUM")
     con.close()
 
-def db_room_upsert(code: str, rounds: int, status: str):
+def db_room_upsert(code: str, rounds: int, status: str, scoring: str = "classic"):
     con = sqlite3.connect(DB_PATH)
     cur = con.cursor()
     cur.execute(
-        "INSERT OR IGNORE INTO rooms(code, created_at, rounds, status) VALUES(?,?,?,?)",
-        (code, int(time.time()), rounds, status)
+        "INSERT OR IGNORE INTO rooms(code, created_at, rounds, status, scoring) VALUES(?,?,?,?,?)",
+        (code, int(time.time()), rounds, status, scoring)
     )
     cur.execute(
-        "UPDATE rooms SET rounds=?, status=? WHERE code=?",
-        (rounds, status, code)
+        "UPDATE rooms SET rounds=?, status=?, scoring=? WHERE code=?",
+        (rounds, status, scoring, code)
     )
     con.commit()
     con.close()
 
-def db_player_upsert(room_code: str, player_id: str, name: str, score: int):
+def db_player_upsert(room_code: str, player_id: str, name: str, score: int, time_ms: int = 0):
     con = sqlite3.connect(DB_PATH)
     cur = con.cursor()
     cur.execute("""
-        INSERT OR REPLACE INTO players(id, room_code, player_id, name, score)
+        INSERT OR REPLACE INTO players(id, room_code, player_id, name, score, time_ms)
         VALUES(
             COALESCE((SELECT id FROM players WHERE room_code=? AND player_id=?), NULL),
-            ?,?,?,?
+            ?,?,?,?,?
         )
-    """, (room_code, player_id, room_code, player_id, name, score))
+    """, (room_code, player_id, room_code, player_id, name, score, time_ms))
     con.commit()
     con.close()
 
@@ -117,23 +183,51 @@ def db_answer_add(room_code, round_no, qid, category, player_id, player_name,
         VALUES(?,?,?,?,?,?,?,?,?,?,?)
     """, (room_code, round_no, qid, category, player_id, player_name,
           text, None if choice is None else int(choice), int(is_correct), awarded, time_spent_ms))
+    cur.execute("""
+        INSERT INTO question_stats(question_id, correct, total) VALUES(?,?,1)
+        ON CONFLICT(question_id) DO UPDATE SET
+            correct = correct + excluded.correct,
+            total = total + 1
+    """, (qid, int(is_correct)))
     con.commit()
     con.close()
 
+def _db_has_room(path: Path, code: str) -> bool:
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    cur.execute("SELECT 1 FROM rooms WHERE code=?", (code,))
+    row = cur.fetchone()
+    con.close()
+    return bool(row)
+
+def exists_in_db(code: str) -> bool:
+    if _db_has_room(DB_PATH, code):
+        return True
+    return ARCHIVE_DB_PATH.exists() and _db_has_room(ARCHIVE_DB_PATH, code)
+
+def _room_db_path(code: str) -> Path:
+    """База, в которой лежит комната: рабочая или архивная."""
+    if ARCHIVE_DB_PATH.exists() and not _db_has_room(DB_PATH, code) \
+            and _db_has_room(ARCHIVE_DB_PATH, code):
+        return ARCHIVE_DB_PATH
+    return DB_PATH
+
 def db_room_results(room_code: str):
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(_room_db_path(room_code))
     cur = con.cursor()
-    cur.execute("SELECT rounds, status FROM rooms WHERE code=?", (room_code,))
+    cur.execute("SELECT rounds, status, scoring FROM rooms WHERE code=?", (room_code,))
     row = cur.fetchone()
     rounds = row[0] if row else 0
     status = row[1] if row else "unknown"
+    scoring = (row[2] if row else None) or "classic"
 
     cur.execute("""
-        SELECT player_id, name, score FROM players
+        SELECT player_id, name, score, time_ms FROM players
         WHERE room_code=?
-        ORDER BY score DESC, name ASC
+        ORDER BY score DESC, time_ms ASC, name ASC
     """, (room_code,))
-    players = [{"playerId": r[0], "name": r[1], "score": r[2]} for r in cur.fetchall()]
+    players = [{"playerId": r[0], "name": r[1], "score": r[2], "totalTimeMs": r[3] or 0}
+               for r in cur.fetchall()]
 
     cur.execute("""
         SELECT round_no, question_id, category, player_id, player_name,
@@ -150,7 +244,73 @@ def db_room_results(room_code: str):
         "awarded": r[8], "timeMs": r[9]
     } for r in cur.fetchall()]
     con.close()
-    return {"roomCode": room_code, "rounds": rounds, "status": status, "players": players, "answers": answers}
+    return {"roomCode": room_code, "rounds": rounds, "status": status, "scoring": scoring,
+            "players": players, "answers": answers}
+
+def db_question_stats() -> Dict[str, tuple]:
+    """Наблюдаемая статистика по вопросам: {question_id: (верных, всего)}."""
+    con = sqlite3.connect(DB_PATH)
+    cur = con.cursor()
+    cur.execute("SELECT question_id, correct, total FROM question_stats")
+    stats = {r[0]: (int(r[1] or 0), int(r[2] or 0)) for r in cur.fetchall()}
+    con.close()
+    return stats
+
+def db_archive_rooms(older_than_days: int = ARCHIVE_AFTER_DAYS, keep_codes=()) -> int:
+    """
+    Переносит завершённые комнаты старше older_than_days (вместе с игроками и
+    ответами) в архивную базу и возвращает освободившиеся страницы рабочей.
+    Перенос идёт пачками по ARCHIVE_BATCH комнат, каждая — отдельной транзакцией
+    по обеим базам, чтобы не держать блокировку рабочей базы надолго.
+    Возвращает число перенесённых комнат.
+    """
+    cutoff = int(time.time()) - older_than_days * 86400
+    con = sqlite3.connect(DB_PATH)
+    cur = con.cursor()
+    archived = 0
+    try:
+        cur.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+        _create_tables(cur, "archive")
+        cur.execute(
+            "SELECT code FROM main.rooms WHERE status='finished' AND created_at < ?",
+            (cutoff,)
+        )
+        codes = [r[0] for r in cur.fetchall() if r[0] not in keep_codes]
+        if not codes:
+            return 0
+
+        cur.execute("CREATE TEMP TABLE archive_codes(code TEXT PRIMARY KEY)")
+        for start in range(0, len(codes), ARCHIVE_BATCH):
+            if start:
+                time.sleep(ARCHIVE_BATCH_PAUSE_S)
+            batch = codes[start:start + ARCHIVE_BATCH]
+            cur.execute("DELETE FROM archive_codes")
+            cur.executemany("INSERT INTO archive_codes VALUES(?)", [(c,) for c in batch])
+            cur.execute(f"""
+                INSERT OR REPLACE INTO archive.rooms({ROOM_COLUMNS})
+                SELECT {ROOM_COLUMNS} FROM main.rooms WHERE code IN (SELECT code FROM archive_codes)
+            """)
+            cur.execute(f"""
+                INSERT INTO archive.players({PLAYER_COLUMNS})
+                SELECT {PLAYER_COLUMNS} FROM main.players WHERE room_code IN (SELECT code FROM archive_codes)
+            """)
+            cur.execute(f"""
+                INSERT INTO archive.answers({ANSWER_COLUMNS})
+                SELECT {ANSWER_COLUMNS} FROM main.answers WHERE room_code IN (SELECT code FROM archive_codes)
+            """)
+            for table, column in (("answers", "room_code"), ("players", "room_code"), ("rooms", "code")):
+                cur.execute(f"DELETE FROM main.{table} WHERE {column} IN (SELECT code FROM archive_codes)")
+            con.commit()
+            archived += len(batch)
+
+        cur.execute("PRAGMA main.incremental_vacuum")
+        cur.fetchall()
+        return archived
+    except sqlite3.Error:
+        con.rollback()
+        raise
+    finally:
+        con.close()
 
 # ====================== TASKS ======================
 def _normalize_answer(s: str) -> str:
@@ -159,17 +319,30 @@ def _normalize_answer(s: str) -> str:
     s = re.sub(r"\s+", " ", s)
     return s.lower()
 
-def _is_correct_text(user_text: str, accepted: List[str]) -> bool:
+def _answer_keys(accepted: List[str]):
+    """Нормализованные варианты ответа и числовое значение первого из них."""
+    keys = [_normalize_answer(a) for a in accepted]
+    try:
+        num = float(keys[0]) if keys else None
+    except ValueError:
+        num = None
+    return keys, num
+
+def _is_correct_text(user_text: str, accepted: List[str],
+                     keys: Optional[List[str]] = None,
+                     num: Optional[float] = None) -> bool:
     if not accepted:
         return False
+    if keys is None:
+        keys, num = _answer_keys(accepted)
     u = _normalize_answer(user_text)
-    for a in accepted or []:
-        if _normalize_answer(a) == u:
-            return True
+    if u in keys:
+        return True
+    if num is None:
+        return False
     try:
-        au = _normalize_answer(accepted[0])
-        return float(u) == float(au)
-    except Exception:
+        return float(u) == num
+    except ValueError:
         return False
 
 def _check_robot_pair_to_target(ans_text: str) -> bool:
@@ -198,18 +371,9 @@ def _check_word_ladder_lisa_nora(ans_text: str) -> bool:
         return False
     return True
 
-def load_tasks_raw() -> dict:
-    if not TASKS_PATH.exists():
-        TASKS_PATH.write_text("{}", encoding="utf-8")
-    try:
-        with open(TASKS_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
-
 def transform_tasks(raw: dict) -> Dict[str, List[dict]]:
     out: Dict[str, List[dict]] = {}
+    seen_ids: set = set()
     id_counter = 1
 
     for category, arr in (raw or {}).items():
@@ -247,11 +411,21 @@ def transform_tasks(raw: dict) -> Dict[str, List[dict]]:
                     opts = q.get("options") or []
                     if not opts or q.get("correctIndex") is None:
                         continue
+                    try:
+                        ci = int(q.get("correctIndex"))
+                    except (TypeError, ValueError):
+                        continue
+                    if not 0 <= ci < len(opts):
+                        continue
                     item["options"] = [str(x) for x in opts]
-                    item["correctIndex"] = int(q.get("correctIndex"))
+                    item["correctIndex"] = ci
                 else:
                     acc = q.get("accept") or []
                     item["accept"] = [str(x) for x in acc]
+                    item["acceptKeys"], item["acceptNum"] = _answer_keys(item["accept"])
+                if item["id"] in seen_ids:
+                    continue
+                seen_ids.add(item["id"])
                 out_list.append(item)
                 continue
 
@@ -265,6 +439,10 @@ def transform_tasks(raw: dict) -> Dict[str, List[dict]]:
                     "mode": "base"
                 }
                 id_counter += 1
+                item["acceptKeys"], item["acceptNum"] = _answer_keys(item["accept"])
+                if item["id"] in seen_ids:
+                    continue
+                seen_ids.add(item["id"])
                 out_list.append(item)
                 continue
 
@@ -273,8 +451,64 @@ def transform_tasks(raw: dict) -> Dict[str, List[dict]]:
 
     return out
 
-RAW_TASKS = load_tasks_raw()
-TASK_BANK = transform_tasks(RAW_TASKS)
+# Скомпилированный банк: заголовок + marshal уже преобразованных задач.
+# Кэш лежит рядом с tasks.json и сбрасывается по sha256 его содержимого;
+# читается через mmap, так что воркеры делят страницы файла в page cache.
+BANK_MAGIC = b"SONPBANK"
+BANK_FORMAT = 1
+BANK_HEADER = struct.Struct("<8sHHH32sQ")  # magic, формат, python major/minor, sha256, длина
+
+def _bank_stamp():
+    return BANK_FORMAT, sys.version_info[0], sys.version_info[1]
+
+def compile_task_bank(json_bytes: bytes) -> Dict[str, List[dict]]:
+    """Разбирает tasks.json, сохраняет скомпилированный банк и возвращает его."""
+    try:
+        raw = json.loads(json_bytes.decode("utf-8"))
+    except Exception:
+        raw = {}
+    bank = transform_tasks(raw if isinstance(raw, dict) else {})
+
+    payload = marshal.dumps(bank)
+    header = BANK_HEADER.pack(BANK_MAGIC, *_bank_stamp(),
+                              hashlib.sha256(json_bytes).digest(), len(payload))
+    tmp = TASKS_BANK_PATH.with_name(TASKS_BANK_PATH.name + f".{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp, TASKS_BANK_PATH)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+    return bank
+
+def _read_task_bank(digest: bytes) -> Optional[Dict[str, List[dict]]]:
+    try:
+        with open(TASKS_BANK_PATH, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < BANK_HEADER.size:
+                return None
+            magic, fmt, major, minor, sha, size = BANK_HEADER.unpack_from(mm)
+            if magic != BANK_MAGIC or (fmt, major, minor) != _bank_stamp() or sha != digest:
+                return None
+            if len(mm) != BANK_HEADER.size + size:
+                return None
+            with memoryview(mm) as view:
+                bank = marshal.loads(view[BANK_HEADER.size:])
+            return bank if isinstance(bank, dict) else None
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+
+def load_task_bank() -> Dict[str, List[dict]]:
+    if not TASKS_PATH.exists():
+        TASKS_PATH.write_text("{}", encoding="utf-8")
+    json_bytes = TASKS_PATH.read_bytes()
+    bank = _read_task_bank(hashlib.sha256(json_bytes).digest())
+    if bank is None:
+        bank = compile_task_bank(json_bytes)
+    return bank
+
+TASK_BANK = load_task_bank()
 CATEGORIES = list(TASK_BANK.keys())
 
 def task_counts():
@@ -343,7 +577,136 @@ def pick_question(used_ids: set,
     cat = random.choice(CATEGORIES)
     return random.choice(TASK_BANK[cat])
 
+# ====================== SCHEDULER ======================
+PLAN_MIN_SAMPLES = 5      # сколько ответов нужно, чтобы учитывать наблюдаемую долю верных
+PLAN_PRIOR_WEIGHT = 10    # вес номинальной сложности при смешивании с наблюдаемой
+PLAN_TAG_RETRIES = 8      # попыток найти вопрос без повторяющихся тегов
+
+def _difficulty_of(q: dict) -> float:
+    try:
+        return float(q.get("difficulty", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+def _tags_of(q: dict) -> List[str]:
+    tags = q.get("tags") or []
+    if isinstance(tags, str):
+        return [tags]
+    return [str(t) for t in tags]
+
+def _effective_difficulty(q: dict, d_lo: float, d_hi: float,
+                          stats: Optional[Dict[str, tuple]]) -> float:
+    """
+    Номинальная сложность, сдвинутая к наблюдаемой: доля верных ответов
+    переводится в шкалу [d_lo, d_hi] и смешивается с номинальной пропорционально
+    числу ответов.
+    """
+    d = _difficulty_of(q)
+    st = (stats or {}).get(q["id"])
+    if not st or st[1] < PLAN_MIN_SAMPLES:
+        return d
+    correct, total = st
+    observed = d_lo + (1.0 - correct / total) * (d_hi - d_lo)
+    return (d * PLAN_PRIOR_WEIGHT + observed * total) / (PLAN_PRIOR_WEIGHT + total)
+
+def _desired_mode(round_no: int, task_filter_mode: str, has_card: bool) -> str:
+    if task_filter_mode == "cards_only":
+        return "card"
+    if task_filter_mode == "no_cards":
+        return "base"
+    if has_card and round_no % 2 == 0:
+        return "card"
+    return "base"
+
+def _draw_from_bucket(bucket: List[dict], used_tags: set) -> dict:
+    """Случайный вопрос из корзины без возврата, по возможности с новыми тегами."""
+    n = len(bucket)
+    pick = None
+    for _ in range(min(n, PLAN_TAG_RETRIES)):
+        i = random.randrange(n)
+        if used_tags.isdisjoint(_tags_of(bucket[i])):
+            pick = i
+            break
+    if pick is None:
+        pick = random.randrange(n)
+    bucket[pick], bucket[-1] = bucket[-1], bucket[pick]
+    return bucket.pop()
+
+def plan_rounds(rounds: int,
+                task_filter_mode: str = "all",
+                used_ids: Optional[set] = None,
+                stats: Optional[Dict[str, tuple]] = None) -> List[dict]:
+    """
+    План вопросов на всю игру: сложность растёт от раунда к раунду,
+    категории чередуются, теги по возможности не повторяются.
+
+    Банк один раз раскладывается по корзинам (режим, категория, уровень),
+    дальше на каждый раунд взвешенно выбирается корзина, а из неё — вопрос.
+    Стоимость раунда зависит от числа корзин, а не от размера банка.
+    stats — результат db_question_stats() для адаптивной сложности.
+    """
+    used_ids = set(used_ids or ())
+    pool = [
+        q for q in _all_tasks()
+        if q["id"] not in used_ids and _allowed_by_filter(q, task_filter_mode)
+    ]
+    diffs = [_difficulty_of(q) for q in pool]
+    d_lo, d_hi = (min(diffs), max(diffs)) if diffs else (1.0, 1.0)
+
+    buckets: Dict[tuple, List[dict]] = {}
+    for q in pool:
+        level = int(round(_effective_difficulty(q, d_lo, d_hi, stats)))
+        buckets.setdefault((q.get("mode", "base"), q["category"], level), []).append(q)
+
+    mode_levels: Dict[str, tuple] = {}
+    for mode, _, level in buckets:
+        lo, hi = mode_levels.get(mode, (level, level))
+        mode_levels[mode] = (min(lo, level), max(hi, level))
+    has_card = "card" in mode_levels
+
+    cat_used: Dict[str, int] = {}
+    used_tags: set = set()
+    plan: List[dict] = []
+
+    for r in range(1, rounds + 1):
+        desired_mode = _desired_mode(r, task_filter_mode, has_card)
+        keys = [k for k, b in buckets.items() if b and k[0] == desired_mode]
+        if not keys:
+            keys = [k for k, b in buckets.items() if b]
+
+        if keys:
+            progress = (r - 1) / (rounds - 1) if rounds > 1 else 0.0
+            weights = []
+            for mode, cat, level in keys:
+                lo, hi = mode_levels[mode]
+                target = lo + (hi - lo) * progress
+                w = 1.0 / (1.0 + abs(level - target)) ** 2
+                w /= (1 + cat_used.get(cat, 0)) ** 2
+                weights.append(w)
+            key = random.choices(keys, weights=weights)[0]
+            q = _draw_from_bucket(buckets[key], used_tags)
+            cat_used[key[1]] = cat_used.get(key[1], 0) + 1
+            used_tags.update(_tags_of(q))
+        else:
+            q = pick_question(used_ids, desired_mode=desired_mode, task_filter_mode=task_filter_mode)
+
+        used_ids.add(q["id"])
+        plan.append(q)
+
+    return plan
+
 # ====================== ROOMS ======================
+SPEED_BASE_POINTS = 10    # режим speed: очки за верный ответ
+SPEED_MAX_BONUS = 10      # плюс бонус, линейно убывающий до нуля к концу раунда
+
+def round_points(scoring: str, ok: bool, time_ms: int, time_limit: int) -> int:
+    if not ok:
+        return 0
+    if scoring != "speed" or time_limit <= 0:
+        return 1
+    left = max(0.0, 1.0 - time_ms / (time_limit * 1000))
+    return SPEED_BASE_POINTS + int(round(SPEED_MAX_BONUS * left))
+
 def gen_code() -> str:
     alphabet = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
     return "".join(random.choice(alphabet) for _ in range(4))
@@ -358,6 +721,7 @@ class PlayerConn:
     ans_text: str = ""
     ans_choice: Optional[int] = None
     ans_time_ms: int = 0
+    total_time_ms: int = 0          # суммарное время верных ответов, для разрешения ничьих
 
 @dataclass
 class Room:
@@ -369,13 +733,21 @@ class Room:
     current_round: int = 0
     current_question: Optional[dict] = None
     used_ids: set = field(default_factory=set)
-    round_deadline: float = 0.0
+    round_started: float = 0.0      # time.monotonic()
+    round_deadline: float = 0.0     # time.monotonic()
     time_limit: int = 0
     timer_task: Optional[asyncio.Task] = None
     task_filter_mode: str = "all"   # all | cards_only | no_cards
+    adaptive: bool = False          # учитывать наблюдаемую долю верных при планировании
+    round_plan: List[dict] = field(default_factory=list)
+    scoring: str = "classic"        # classic | speed
+    board_seq: int = 0              # номер последней разосланной таблицы очков
+    board_last: Dict[str, dict] = field(default_factory=dict)
 
     def snapshot_players(self):
-        return [{"playerId": p.id, "name": p.name, "score": p.score} for p in self.players.values()]
+        ranked = sorted(self.players.values(), key=lambda p: (-p.score, p.total_time_ms))
+        return [{"playerId": p.id, "name": p.name, "score": p.score, "totalTimeMs": p.total_time_ms}
+                for p in ranked]
 
 ROOMS: Dict[str, Room] = {}
 CLIENT_TO_ROOM: Dict[WebSocket, str] = {}
@@ -392,6 +764,21 @@ app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 def on_startup():
     db_init()
 
+@app.on_event("startup")
+async def start_archiver():
+    asyncio.create_task(archive_loop())
+
+def _live_room_codes() -> set:
+    return {code for code, room in ROOMS.items() if room.status != "finished"}
+
+async def archive_loop():
+    while True:
+        try:
+            await asyncio.to_thread(db_archive_rooms, ARCHIVE_AFTER_DAYS, _live_room_codes())
+        except Exception:
+            log.exception("archive run failed")
+        await asyncio.sleep(ARCHIVE_INTERVAL_S)
+
 @app.get("/", response_class=HTMLResponse)
 def root():
     return FileResponse(APP_DIR / "index.html")
@@ -406,12 +793,16 @@ def api_tasks():
 
 @app.post("/api/tasks/reload")
 def api_tasks_reload():
-    global RAW_TASKS, TASK_BANK, CATEGORIES
-    RAW_TASKS = load_tasks_raw()
-    TASK_BANK = transform_tasks(RAW_TASKS)
+    global TASK_BANK, CATEGORIES
+    TASK_BANK = load_task_bank()
     CATEGORIES = list(TASK_BANK.keys())
     return JSONResponse({"ok": True, **task_counts()})
 
+@app.post("/api/archive")
+def api_archive(days: int = ARCHIVE_AFTER_DAYS):
+    archived = db_archive_rooms(max(0, days), _live_room_codes())
+    return JSONResponse({"ok": True, "archived": archived})
+
 @app.get("/api/room/{code}/results")
 def api_room_results(code: str):
     code = code.upper()
@@ -419,17 +810,9 @@ def api_room_results(code: str):
         return JSONResponse({"error": "room not found"}, status_code=404)
     return JSONResponse(db_room_results(code))
 
-def exists_in_db(code: str) -> bool:
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("SELECT 1 FROM rooms WHERE code=?", (code,))
-    row = cur.fetchone()
-    con.close()
-    return bool(row)
-
 @app.get("/api/export/{code}/player/{player_id}.csv")
 def export_player_csv(code: str, player_id: str):
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(_room_db_path(code.upper()))
     cur = con.cursor()
     cur.execute("""
         SELECT round_no, question_id, category, answer_text, answer_choice, is_correct, awarded, time_spent_ms
@@ -466,136 +849,354 @@ def export_room_csv(code: str):
     )
 
 # ====================== WebSocket ======================
-@app.websocket("/ws")
-async def ws_endpoint(ws: WebSocket):
-    await ws.accept()
-    try:
-        while True:
-            raw = await ws.receive_text()
-            msg = json.loads(raw)
-            t = msg.get("type")
-
-            if t == "admin_create_room":
-                code = (msg.get("preferredCode") or gen_code()).upper()
-                if code in ROOMS:
-                    code = gen_code()
-
-                tfm = msg.get("taskFilterMode", "all")
-                if tfm not in ("all", "cards_only", "no_cards"):
-                    tfm = "all"
-
-                room = Room(code=code, rounds=int(msg.get("rounds", 6)), task_filter_mode=tfm)
-                ROOMS[code] = room
-                room.admin = ws
-                CLIENT_TO_ROOM[ws] = code
-                db_room_upsert(code, room.rounds, "lobby")
-                await ws.send_json({
-                    "type": "room_created",
-                    "roomCode": code,
-                    "taskFilterMode": room.task_filter_mode
-                })
-                continue
+MAX_FRAME_SIZE = 4096         # символов в текстовом кадре / байт в бинарном
+MAX_REJECTS_PER_CONN = 50     # после стольких отклонённых кадров соединение закрывается
+# причины отказа, которые считаются к MAX_REJECTS_PER_CONN
+CLOSE_REASONS = {"too_large", "bad_json", "schema", "unknown_type", "binary"}
+MAX_ROUNDS = 30               # как и ограничение поля «Раундов» в admin.html
+
+# тип сообщения: (токенов в секунду, ёмкость); "*" — общий лимит на любые кадры
+RATE_LIMITS: Dict[str, tuple] = {
+    "*": (10.0, 20),
+    "answer": (2.0, 4),
+    "join": (0.5, 3),
+    "admin_create_room": (0.5, 3),
+    "admin_attach": (1.0, 3),
+    "sync": (1.0, 3),
+}
+
+# Подпротоколы /ws. sonp.msgpack — бинарные кадры MessagePack с короткими
+# ключами; в рассылках players/scores заменяются дельтой таблицы очков.
+# Клиенты без подпротокола (и sonp.json) получают прежний JSON.
+PROTO_MSGPACK = "sonp.msgpack"
+PROTO_JSON = "sonp.json"
+
+# Должно совпадать с SHORT в static/wire.js
+SHORT_KEYS: Dict[str, str] = {
+    "type": "t", "roomCode": "rc", "playerId": "pid", "playerName": "pn", "preferredCode": "pc",
+    "players": "ps", "scores": "sc", "score": "s", "name": "n", "timeMs": "tm",
+    "totalTimeMs": "ttm",
+    "round": "r", "rounds": "rs", "totalRounds": "tr", "category": "c", "questionId": "q",
+    "timeLimit": "tl", "qtype": "qt", "prompt": "p", "mode": "m", "subtype": "st", "options": "o",
+    "results": "res", "choice": "ch", "text": "tx", "isCorrect": "ok", "awarded": "aw",
+    "correctIndex": "ci", "correctText": "ct", "accepted": "ac", "status": "stt",
+    "taskFilterMode": "tfm", "adaptiveDifficulty": "ad", "scoringMode": "sm", "message": "msg",
+    "seq": "sq", "base": "b", "changed": "chg", "removed": "rm",
+}
+LONG_KEYS: Dict[str, str] = {v: k for k, v in SHORT_KEYS.items()}
+
+WS_PROTOCOL: Dict[WebSocket, str] = {}
+
+def _rename_keys(obj, table: Dict[str, str]):
+    if isinstance(obj, dict):
+        return {table.get(k, k): _rename_keys(v, table) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_rename_keys(v, table) for v in obj]
+    return obj
+
+def _negotiate(offered: List[str]) -> Optional[str]:
+    if msgpack is not None and PROTO_MSGPACK in offered:
+        return PROTO_MSGPACK
+    if PROTO_JSON in offered:
+        return PROTO_JSON
+    return None
+
+def _encode(proto: Optional[str], payload: dict):
+    if proto == PROTO_MSGPACK:
+        return msgpack.packb(_rename_keys(payload, SHORT_KEYS), use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+async def _send_frame(ws: WebSocket, frame):
+    if isinstance(frame, bytes):
+        await ws.send_bytes(frame)
+    else:
+        await ws.send_text(frame)
 
-            if t == "admin_attach":
-                code = msg["roomCode"].upper()
-                room = ROOMS.get(code)
-                if not room:
-                    await ws.send_json({"type": "error", "message": "Комната не найдена"})
-                    continue
-                room.admin = ws
-                CLIENT_TO_ROOM[ws] = code
-                await ws.send_json({
-                    "type": "room_attached",
-                    "roomCode": code,
-                    "players": room.snapshot_players(),
-                    "status": room.status,
-                    "taskFilterMode": room.task_filter_mode
-                })
-                continue
+async def send_msg(ws: WebSocket, payload: dict):
+    await _send_frame(ws, _encode(WS_PROTOCOL.get(ws), payload))
 
-            if t == "join":
-                code = msg["roomCode"].upper()
-                name = str(msg.get("playerName", "Игрок")).strip()[:32]
-                room = ROOMS.get(code)
-                if not room:
-                    await ws.send_json({"type": "error", "message": "Комната не найдена"})
-                    continue
-                if room.status != "lobby":
-                    await ws.send_json({"type": "error", "message": "Игра уже идёт"})
-                    continue
-                if len(room.players) >= 10:
-                    await ws.send_json({"type": "error", "message": "Комната заполнена"})
-                    continue
-                pid = msg.get("playerId") or ("p_" + "".join(random.choices(string.ascii_lowercase + string.digits, k=8)))
-                pc = PlayerConn(ws=ws, id=pid, name=name)
-                room.players[pid] = pc
-                CLIENT_TO_ROOM[ws] = code
-                db_player_upsert(room.code, pid, name, 0)
-                await ws.send_json({"type": "joined", "roomCode": code, "playerId": pid, "players": room.snapshot_players()})
-                await broadcast(code, {"type": "players", "players": room.snapshot_players()})
-                continue
+# причина -> число отклонённых кадров с момента запуска
+WS_REJECTS: Dict[str, int] = {}
 
-            if t == "admin_start":
-                code = msg["roomCode"].upper()
-                room = ROOMS.get(code)
-                if not room or room.admin is not ws:
-                    await ws.send_json({"type": "error", "message": "Нет прав/комната не найдена"})
-                    continue
-                if len(room.players) == 0:
-                    await ws.send_json({"type": "error", "message": "Нет игроков"})
-                    continue
-                room.status = "running"
-                db_room_upsert(code, room.rounds, "running")
-                await broadcast(code, {"type": "game_started", "rounds": room.rounds})
-                asyncio.create_task(run_rounds(room))
-                continue
+@dataclass
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float = 0.0
+    updated: float = 0.0
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
 
-            if t == "answer":
-                code = msg["roomCode"].upper()
-                room = ROOMS.get(code)
-                if not room:
-                    continue
-                pid = msg.get("playerId")
-                pc = room.players.get(pid)
-                if not pc or room.status != "running" or room.current_question is None:
-                    continue
-                if pc.answered:
-                    continue
-                now = time.time()
-                if now > room.round_deadline:
-                    continue
+@dataclass
+class ConnLimits:
+    buckets: Dict[str, TokenBucket] = field(default_factory=dict)
+    rejects: int = 0
 
-                q = room.current_question
-                if q["type"] == "mcq":
-                    ch = msg.get("choice")
-                    try:
-                        pc.ans_choice = int(ch) if ch is not None else None
-                    except Exception:
-                        pc.ans_choice = None
-                    pc.ans_text = ""
-                else:
-                    pc.ans_text = str(msg.get("text", ""))[:300]
-                    pc.ans_choice = None
+    def allow(self, kind: str, now: float) -> bool:
+        limit = RATE_LIMITS.get(kind)
+        if not limit:
+            return True
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            rate, capacity = limit
+            bucket = self.buckets[kind] = TokenBucket(rate, capacity, capacity, now)
+        return bucket.take(now)
+
+def _reject(conn: ConnLimits, reason: str) -> int:
+    # rate_limited — обычный троттлинг (например, игрок быстро перещёлкивает
+    # варианты ответа), кадр просто отбрасывается и к закрытию не ведёт
+    WS_REJECTS[reason] = WS_REJECTS.get(reason, 0) + 1
+    if reason in CLOSE_REASONS:
+        conn.rejects += 1
+    return conn.rejects
+
+def _schema_error(msg: dict, schema: Dict[str, tuple]) -> Optional[str]:
+    """Имя первого поля, не прошедшего проверку, или None."""
+    for key, (types, required) in schema.items():
+        value = msg.get(key)
+        if value is None:
+            if required:
+                return key
+            continue
+        if not isinstance(value, types):
+            return key
+    return None
+
+def _check_frame(frame: dict, conn: ConnLimits, now: float, proto: Optional[str] = None):
+    """Разбор входящего кадра: (тип, сообщение, None) или (None, None, причина отказа)."""
+    raw = frame.get("text")
+    if raw is None:
+        raw = frame.get("bytes")
+        if raw is None or proto != PROTO_MSGPACK:
+            return None, None, "binary"
+    if len(raw) > MAX_FRAME_SIZE:
+        return None, None, "too_large"
+    if not conn.allow("*", now):
+        return None, None, "rate_limited"
+    try:
+        if isinstance(raw, bytes):
+            msg = _rename_keys(msgpack.unpackb(raw, raw=False), LONG_KEYS)
+        else:
+            msg = json.loads(raw)
+    except (ValueError, RecursionError):
+        return None, None, "bad_json"
+    if not isinstance(msg, dict):
+        return None, None, "bad_json"
+    t = msg.get("type")
+    entry = WS_HANDLERS.get(t) if isinstance(t, str) else None
+    if entry is None:
+        return None, None, "unknown_type"
+    if _schema_error(msg, entry[1]):
+        return None, None, "schema"
+    if not conn.allow(t, now):
+        return None, None, "rate_limited"
+    return t, msg, None
+
+async def _on_admin_create_room(ws: WebSocket, msg: dict, received: float):
+    code = (msg.get("preferredCode") or gen_code()).upper()
+    if code in ROOMS:
+        code = gen_code()
+
+    tfm = msg.get("taskFilterMode", "all")
+    if tfm not in ("all", "cards_only", "no_cards"):
+        tfm = "all"
+
+    scoring = msg.get("scoringMode", "classic")
+    if scoring not in ("classic", "speed"):
+        scoring = "classic"
 
-                spent_ms = int((now - (room.round_deadline - room.time_limit)) * 1000)
-                pc.ans_time_ms = max(0, spent_ms)
-                pc.answered = True
+    try:
+        rounds = int(msg.get("rounds", 6))
+    except ValueError:
+        rounds = 6
+    rounds = max(1, min(MAX_ROUNDS, rounds))
+
+    room = Room(
+        code=code,
+        rounds=rounds,
+        task_filter_mode=tfm,
+        adaptive=bool(msg.get("adaptiveDifficulty", False)),
+        scoring=scoring
+    )
+    ROOMS[code] = room
+    room.admin = ws
+    CLIENT_TO_ROOM[ws] = code
+    db_room_upsert(code, room.rounds, "lobby", room.scoring)
+    await send_msg(ws, {
+        "type": "room_created",
+        "roomCode": code,
+        "taskFilterMode": room.task_filter_mode,
+        "adaptiveDifficulty": room.adaptive,
+        "scoringMode": room.scoring
+    })
+
+async def _on_admin_attach(ws: WebSocket, msg: dict, received: float):
+    code = msg["roomCode"].upper()
+    room = ROOMS.get(code)
+    if not room:
+        await send_msg(ws, {"type": "error", "message": "Комната не найдена"})
+        return
+    room.admin = ws
+    CLIENT_TO_ROOM[ws] = code
+    await send_msg(ws, {
+        "type": "room_attached",
+        "roomCode": code,
+        "players": room.snapshot_players(),
+        "status": room.status,
+        "taskFilterMode": room.task_filter_mode,
+        "adaptiveDifficulty": room.adaptive,
+        "scoringMode": room.scoring,
+        "seq": room.board_seq
+    })
+
+async def _on_join(ws: WebSocket, msg: dict, received: float):
+    code = msg["roomCode"].upper()
+    name = str(msg.get("playerName", "Игрок")).strip()[:32]
+    room = ROOMS.get(code)
+    if not room:
+        await send_msg(ws, {"type": "error", "message": "Комната не найдена"})
+        return
+    if room.status != "lobby":
+        await send_msg(ws, {"type": "error", "message": "Игра уже идёт"})
+        return
+    if len(room.players) >= 10:
+        await send_msg(ws, {"type": "error", "message": "Комната заполнена"})
+        return
+    pid = msg.get("playerId") or ("p_" + "".join(random.choices(string.ascii_lowercase + string.digits, k=8)))
+    pc = PlayerConn(ws=ws, id=pid, name=name)
+    room.players[pid] = pc
+    CLIENT_TO_ROOM[ws] = code
+    db_player_upsert(room.code, pid, name, 0)
+    await send_msg(ws, {"type": "joined", "roomCode": code, "playerId": pid,
+                        "players": room.snapshot_players(), "seq": room.board_seq})
+    await broadcast(code, {"type": "players", "players": room.snapshot_players()})
+
+async def _on_admin_start(ws: WebSocket, msg: dict, received: float):
+    code = msg["roomCode"].upper()
+    room = ROOMS.get(code)
+    if not room or room.admin is not ws:
+        await send_msg(ws, {"type": "error", "message": "Нет прав/комната не найдена"})
+        return
+    if len(room.players) == 0:
+        await send_msg(ws, {"type": "error", "message": "Нет игроков"})
+        return
+    room.status = "running"
+    db_room_upsert(code, room.rounds, "running", room.scoring)
+    await broadcast(code, {"type": "game_started", "rounds": room.rounds})
+    asyncio.create_task(run_rounds(room))
+
+async def _on_answer(ws: WebSocket, msg: dict, received: float):
+    code = msg["roomCode"].upper()
+    room = ROOMS.get(code)
+    if not room:
+        return
+    pid = msg.get("playerId")
+    pc = room.players.get(pid)
+    if not pc or pc.ws is not ws or room.status != "running" or room.current_question is None:
+        return
+    if pc.answered:
+        return
+    if received > room.round_deadline:
+        return
 
-                if all(p.answered for p in room.players.values()):
-                    if room.timer_task and not room.timer_task.done():
-                        room.timer_task.cancel()
-                    await finish_round(room)
-                continue
+    q = room.current_question
+    if q["type"] == "mcq":
+        ch = msg.get("choice")
+        try:
+            pc.ans_choice = int(ch) if ch is not None else None
+        except Exception:
+            pc.ans_choice = None
+        pc.ans_text = ""
+    else:
+        pc.ans_text = str(msg.get("text", ""))[:300]
+        pc.ans_choice = None
+
+    spent_ms = int((received - room.round_started) * 1000)
+    pc.ans_time_ms = max(0, spent_ms)
+    pc.answered = True
+
+    if all(p.answered for p in room.players.values()):
+        if room.timer_task and not room.timer_task.done():
+            room.timer_task.cancel()
+        await finish_round(room)
+
+async def _on_admin_end(ws: WebSocket, msg: dict, received: float):
+    code = msg["roomCode"].upper()
+    room = ROOMS.get(code)
+    if room and room.admin is ws:
+        room.status = "finished"
+        db_room_upsert(code, room.rounds, "finished", room.scoring)
+        await broadcast(code, {"type": "final", "scores": room.snapshot_players()})
+
+async def _on_sync(ws: WebSocket, msg: dict, received: float):
+    # клиент sonp.msgpack пропустил дельту таблицы очков и просит полный снимок
+    room = ROOMS.get(CLIENT_TO_ROOM.get(ws, ""))
+    if room:
+        await send_msg(ws, {"type": "players", "players": room.snapshot_players(), "seq": room.board_seq})
+
+# тип сообщения: (обработчик, схема {поле: (допустимые типы, обязательное)})
+WS_HANDLERS: Dict[str, tuple] = {
+    "admin_create_room": (_on_admin_create_room, {
+        "preferredCode": (str, False),
+        "rounds": ((int, str), False),
+        "taskFilterMode": (str, False),
+        "adaptiveDifficulty": (bool, False),
+        "scoringMode": (str, False),
+    }),
+    "admin_attach": (_on_admin_attach, {"roomCode": (str, True)}),
+    "join": (_on_join, {
+        "roomCode": (str, True),
+        "playerName": (str, False),
+        "playerId": (str, False),
+    }),
+    "admin_start": (_on_admin_start, {"roomCode": (str, True)}),
+    "answer": (_on_answer, {
+        "roomCode": (str, True),
+        "playerId": (str, True),
+        "text": (str, False),
+        "choice": ((int, str), False),
+    }),
+    "admin_end": (_on_admin_end, {"roomCode": (str, True)}),
+    "sync": (_on_sync, {}),
+}
+
+@app.get("/api/ws/stats")
+def api_ws_stats():
+    return JSONResponse({"rejected": WS_REJECTS})
 
-            if t == "admin_end":
-                code = msg["roomCode"].upper()
-                room = ROOMS.get(code)
-                if room and room.admin is ws:
-                    room.status = "finished"
-                    db_room_upsert(code, room.rounds, "finished")
-                    await broadcast(code, {"type": "final", "scores": room.snapshot_players()})
+@app.websocket("/ws")
+async def ws_endpoint(ws: WebSocket):
+    proto = _negotiate(ws.scope.get("subprotocols") or [])
+    await ws.accept(subprotocol=proto)
+    WS_PROTOCOL[ws] = proto
+    conn = ConnLimits()
+    try:
+        while True:
+            frame = await ws.receive()
+            # метка приёма снимается до любой обработки кадра: по ней считается
+            # время ответа, и очередь обработки внутри воркера на него не влияет
+            received = time.monotonic()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+
+            t, msg, reason = _check_frame(frame, conn, received, proto)
+            if reason:
+                if _reject(conn, reason) >= MAX_REJECTS_PER_CONN:
+                    await ws.close(code=1008)
+                    break
+                if reason == "schema":
+                    await send_msg(ws, {"type": "error", "message": "Некорректное сообщение"})
                 continue
 
+            handler = WS_HANDLERS[t][0]
+            await handler(ws, msg, received)
+
     except WebSocketDisconnect:
         pass
     finally:
@@ -614,34 +1215,28 @@ async def ws_endpoint(ws: WebSocket):
                     del room.players[drop_pid]
                     await safe_broadcast(code, {"type": "players", "players": room.snapshot_players()})
             CLIENT_TO_ROOM.pop(ws, None)
+        WS_PROTOCOL.pop(ws, None)
 
 # ====================== game loop ======================
 async def run_rounds(room: Room):
     room.used_ids = set()
 
     tfm = room.task_filter_mode or "all"
-
-    has_card = any(
-        q.get("mode", "base") == "card" and _allowed_by_filter(q, tfm)
-        for q in _all_tasks()
-    )
+    # статистика и план строятся вне event loop, чтобы не задерживать другие комнаты
+    stats = None
+    if room.adaptive:
+        try:
+            stats = await asyncio.to_thread(db_question_stats)
+        except sqlite3.Error:
+            stats = None  # без статистики планируем по номинальной сложности
+    room.round_plan = await asyncio.to_thread(plan_rounds, room.rounds, task_filter_mode=tfm, stats=stats)
 
     for r in range(1, room.rounds + 1):
         if room.status != "running":
             break
         room.current_round = r
 
-        if tfm == "cards_only":
-            desired_mode = "card"
-        elif tfm == "no_cards":
-            desired_mode = "base"
-        else:
-            if has_card and r % 2 == 0:
-                desired_mode = "card"
-            else:
-                desired_mode = "base"
-
-        q = pick_question(room.used_ids, desired_mode=desired_mode, task_filter_mode=tfm)
+        q = room.round_plan[r - 1]
         room.used_ids.add(q["id"])
         room.current_question = q
 
@@ -653,7 +1248,8 @@ async def run_rounds(room: Room):
 
         tl = int(q.get("timeRef") or random.randint(40, 60))
         room.time_limit = tl
-        room.round_deadline = time.time() + tl
+        room.round_started = time.monotonic()
+        room.round_deadline = room.round_started + tl
 
         payload = {
             "type": "question",
@@ -686,7 +1282,7 @@ async def run_rounds(room: Room):
 
     if room.status == "running":
         room.status = "finished"
-        db_room_upsert(room.code, room.rounds, "finished")
+        db_room_upsert(room.code, room.rounds, "finished", room.scoring)
     await broadcast(room.code, {"type": "final", "scores": room.snapshot_players()})
 
 async def finish_round(room: Room):
@@ -706,12 +1302,15 @@ async def finish_round(room: Room):
             if q["type"] == "mcq":
                 ok = (p.ans_choice is not None) and (int(p.ans_choice) == int(q.get("correctIndex", -1)))
             else:
-                ok = _is_correct_text(p.ans_text, q.get("accept", []))
+                ok = _is_correct_text(p.ans_text, q.get("accept", []),
+                                      q.get("acceptKeys"), q.get("acceptNum"))
 
-        awarded = 1 if ok else 0
+        awarded = round_points(room.scoring, ok, p.ans_time_ms, room.time_limit)
         p.score += awarded
+        if ok:
+            p.total_time_ms += p.ans_time_ms
 
-        db_player_upsert(room.code, p.id, p.name, p.score)
+        db_player_upsert(room.code, p.id, p.name, p.score, p.total_time_ms)
         db_answer_add(
             room.code, room.current_round, q["id"], q["category"], p.id, p.name,
             p.ans_text, p.ans_choice, ok, awarded, p.ans_time_ms
@@ -761,21 +1360,42 @@ async def finish_round(room: Room):
 async def broadcast(room_code: str, payload: dict):
     await safe_broadcast(room_code, payload)
 
+def _board_delta(room: Room, board: List[dict]) -> dict:
+    """Изменения таблицы очков с прошлой рассылки; сдвигает room.board_seq."""
+    current = {p["playerId"]: p for p in board}
+    delta = {
+        "base": room.board_seq,
+        "seq": room.board_seq + 1,
+        "changed": [p for pid, p in current.items() if room.board_last.get(pid) != p],
+        "removed": [pid for pid in room.board_last if pid not in current],
+    }
+    room.board_seq += 1
+    room.board_last = current
+    return delta
+
 async def safe_broadcast(room_code: str, payload: dict):
     room = ROOMS.get(room_code)
     if not room:
         return
+
+    compact = payload
+    for key in ("players", "scores"):
+        if isinstance(payload.get(key), list):
+            compact = {**payload, key: _board_delta(room, payload[key])}
+            break
+
+    # кадр кодируется один раз на подпротокол, а не на каждого получателя
+    frames: Dict[Optional[str], Any] = {}
+    targets = ([room.admin] if room.admin else []) + [pc.ws for pc in list(room.players.values())]
     dead = []
-    if room.admin:
-        try:
-            await room.admin.send_json(payload)
-        except Exception:
-            dead.append(room.admin)
-    for pc in list(room.players.values()):
+    for ws in targets:
+        proto = WS_PROTOCOL.get(ws)
+        if proto not in frames:
+            frames[proto] = _encode(proto, compact if proto == PROTO_MSGPACK else payload)
         try:
-            await pc.ws.send_json(payload)
+            await _send_frame(ws, frames[proto])
         except Exception:
-            dead.append(pc.ws)
+            dead.append(ws)
     for ws in dead:
         CLIENT_TO_ROOM.pop(ws, None)
 
@@ -789,5 +1409,6 @@ if __name__ == "__main__":
         "server:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=True,
+        ws_max_size=MAX_FRAME_SIZE * 4
     )
@@ -1,6 +1,7 @@
+// Требует /static/wire.js (SonpWire), подключённого раньше этого файла.
 (function(){
   const isAdmin = location.pathname.startsWith('/admin');
-  const ws = new WebSocket(`ws://${location.host}/ws`);
+  const ws = SonpWire.connect(`ws://${location.host}/ws`);
 
   // ======== Общие элементы ========
   const $ = (id)=> document.getElementById(id);
@@ -44,18 +45,18 @@
       if (code.length !== 4) { alert('Код — 4 символа'); return; }
       if (!name) { alert('Введите имя'); return; }
       roomCode = code;
-      ws.send(JSON.stringify({type:'join', roomCode: code, playerName: name}));
+      SonpWire.send(ws, {type:'join', roomCode: code, playerName: name});
     };
 
     ui.btnSend.onclick = ()=>{
       if (!roomCode || !playerId) return;
       const text = ui.answerText.value.trim();
-      ws.send(JSON.stringify({type:'answer', roomCode, playerId, text}));
+      SonpWire.send(ws, {type:'answer', roomCode, playerId, text});
       ui.btnSend.disabled = true;
     };
 
     ws.onmessage = (ev)=>{
-      const m = JSON.parse(ev.data);
+      const m = SonpWire.decode(ev.target, ev.data);
       switch(m.type){
         case 'error':
           alert(m.message || 'Ошибка'); break;
@@ -176,17 +177,17 @@
     ui.btnCreate.onclick = ()=>{
       const preferredCode = (ui.prefCode.value || '').toUpperCase().trim();
       const rounds = parseInt(ui.rounds.value || '6', 10) || 6;
-      ws.send(JSON.stringify({type:'admin_create_room', preferredCode, rounds}));
+      SonpWire.send(ws, {type:'admin_create_room', preferredCode, rounds});
     };
 
     ui.btnStart.onclick = ()=>{
       if (!roomCode) return;
-      ws.send(JSON.stringify({type:'admin_start', roomCode}));
+      SonpWire.send(ws, {type:'admin_start', roomCode});
     };
 
     ui.btnEnd.onclick = ()=>{
       if (!roomCode) return;
-      ws.send(JSON.stringify({type:'admin_end', roomCode}));
+      SonpWire.send(ws, {type:'admin_end', roomCode});
     };
 
     ui.btnReload.onclick = async ()=>{
@@ -222,7 +223,7 @@
     };
 
     ws.onmessage = (ev)=>{
-      const m = JSON.parse(ev.data);
+      const m = SonpWire.decode(ev.target, ev.data);
       switch(m.type){
         case 'error':
           alert(m.message || 'Ошибка'); break;
@@ -0,0 +1,226 @@
+// Клиентская часть протокола /ws.
+// Сервер поддерживает два подпротокола: sonp.msgpack (бинарные кадры MessagePack
+// с короткими ключами и дельтами таблицы очков) и sonp.json (обычный JSON).
+// SonpWire.decode() возвращает сообщение в привычном виде: длинные ключи и полный
+// список игроков в players/scores, так что обработчики страниц не меняются.
+(function(global){
+  'use strict';
+
+  const PROTO_MSGPACK = 'sonp.msgpack';
+  const PROTO_JSON = 'sonp.json';
+
+  // Должно совпадать с SHORT_KEYS в server.py
+  const SHORT = {
+    type: 't', roomCode: 'rc', playerId: 'pid', playerName: 'pn', preferredCode: 'pc',
+    players: 'ps', scores: 'sc', score: 's', name: 'n', timeMs: 'tm',
+    totalTimeMs: 'ttm',
+    round: 'r', rounds: 'rs', totalRounds: 'tr', category: 'c', questionId: 'q',
+    timeLimit: 'tl', qtype: 'qt', prompt: 'p', mode: 'm', subtype: 'st', options: 'o',
+    results: 'res', choice: 'ch', text: 'tx', isCorrect: 'ok', awarded: 'aw',
+    correctIndex: 'ci', correctText: 'ct', accepted: 'ac', status: 'stt',
+    taskFilterMode: 'tfm', adaptiveDifficulty: 'ad', scoringMode: 'sm', message: 'msg',
+    seq: 'sq', base: 'b', changed: 'chg', removed: 'rm'
+  };
+  const LONG = {};
+  Object.keys(SHORT).forEach(k => { LONG[SHORT[k]] = k; });
+
+  function renameKeys(v, table){
+    if (Array.isArray(v)) return v.map(x => renameKeys(x, table));
+    if (v && typeof v === 'object' && !(v instanceof Uint8Array)){
+      const out = {};
+      Object.keys(v).forEach(k => { out[table[k] || k] = renameKeys(v[k], table); });
+      return out;
+    }
+    return v;
+  }
+
+  // ---------- MessagePack ----------
+  const te = new TextEncoder();
+  const td = new TextDecoder();
+
+  function pushU32(n, out){
+    out.push((n >>> 24) & 0xff, (n >>> 16) & 0xff, (n >>> 8) & 0xff, n & 0xff);
+  }
+
+  function pushHeader(n, fix, c16, c32, out){
+    if (n < 16) out.push(fix | n);
+    else if (n < 0x10000) out.push(c16, n >> 8, n & 0xff);
+    else { out.push(c32); pushU32(n, out); }
+  }
+
+  function write(v, out){
+    if (v === null || v === undefined){
+      out.push(0xc0);
+    }else if (v === false){
+      out.push(0xc2);
+    }else if (v === true){
+      out.push(0xc3);
+    }else if (typeof v === 'number'){
+      if (Number.isInteger(v) && v >= 0 && v <= 0xffffffff){
+        if (v < 0x80) out.push(v);
+        else if (v < 0x100) out.push(0xcc, v);
+        else if (v < 0x10000) out.push(0xcd, v >> 8, v & 0xff);
+        else { out.push(0xce); pushU32(v, out); }
+      }else if (Number.isInteger(v) && v < 0 && v >= -0x80000000){
+        if (v >= -32) out.push(v & 0xff);
+        else { out.push(0xd2); pushU32(v >>> 0, out); }
+      }else{
+        const dv = new DataView(new ArrayBuffer(8));
+        dv.setFloat64(0, v);
+        out.push(0xcb);
+        for (let i = 0; i < 8; i++) out.push(dv.getUint8(i));
+      }
+    }else if (typeof v === 'string'){
+      const b = te.encode(v);
+      const n = b.length;
+      if (n < 32) out.push(0xa0 | n);
+      else if (n < 0x100) out.push(0xd9, n);
+      else if (n < 0x10000) out.push(0xda, n >> 8, n & 0xff);
+      else { out.push(0xdb); pushU32(n, out); }
+      for (let i = 0; i < n; i++) out.push(b[i]);
+    }else if (Array.isArray(v)){
+      pushHeader(v.length, 0x90, 0xdc, 0xdd, out);
+      v.forEach(x => write(x, out));
+    }else if (typeof v === 'object'){
+      const keys = Object.keys(v).filter(k => v[k] !== undefined);
+      pushHeader(keys.length, 0x80, 0xde, 0xdf, out);
+      keys.forEach(k => { write(k, out); write(v[k], out); });
+    }else{
+      out.push(0xc0);
+    }
+  }
+
+  function encode(value){
+    const out = [];
+    write(value, out);
+    return new Uint8Array(out);
+  }
+
+  function decode(buf){
+    const bytes = buf instanceof Uint8Array ? buf : new Uint8Array(buf);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let pos = 0;
+
+    function str(n){
+      const s = td.decode(bytes.subarray(pos, pos + n));
+      pos += n;
+      return s;
+    }
+    function bin(n){
+      const b = bytes.slice(pos, pos + n);
+      pos += n;
+      return b;
+    }
+    function arr(n){
+      const a = new Array(n);
+      for (let i = 0; i < n; i++) a[i] = read();
+      return a;
+    }
+    function map(n){
+      const o = {};
+      for (let i = 0; i < n; i++){
+        const k = read();
+        o[k] = read();
+      }
+      return o;
+    }
+    function read(){
+      const b = view.getUint8(pos++);
+      if (b < 0x80) return b;
+      if (b < 0x90) return map(b & 0x0f);
+      if (b < 0xa0) return arr(b & 0x0f);
+      if (b < 0xc0) return str(b & 0x1f);
+      if (b >= 0xe0) return b - 0x100;
+      let v;
+      switch (b){
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: v = view.getUint8(pos); pos += 1; return bin(v);
+        case 0xc5: v = view.getUint16(pos); pos += 2; return bin(v);
+        case 0xc6: v = view.getUint32(pos); pos += 4; return bin(v);
+        case 0xca: v = view.getFloat32(pos); pos += 4; return v;
+        case 0xcb: v = view.getFloat64(pos); pos += 8; return v;
+        case 0xcc: v = view.getUint8(pos); pos += 1; return v;
+        case 0xcd: v = view.getUint16(pos); pos += 2; return v;
+        case 0xce: v = view.getUint32(pos); pos += 4; return v;
+        case 0xcf: v = view.getUint32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return v;
+        case 0xd0: v = view.getInt8(pos); pos += 1; return v;
+        case 0xd1: v = view.getInt16(pos); pos += 2; return v;
+        case 0xd2: v = view.getInt32(pos); pos += 4; return v;
+        case 0xd3: v = view.getInt32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return v;
+        case 0xd9: v = view.getUint8(pos); pos += 1; return str(v);
+        case 0xda: v = view.getUint16(pos); pos += 2; return str(v);
+        case 0xdb: v = view.getUint32(pos); pos += 4; return str(v);
+        case 0xdc: v = view.getUint16(pos); pos += 2; return arr(v);
+        case 0xdd: v = view.getUint32(pos); pos += 4; return arr(v);
+        case 0xde: v = view.getUint16(pos); pos += 2; return map(v);
+        case 0xdf: v = view.getUint32(pos); pos += 4; return map(v);
+      }
+      throw new Error('msgpack: неподдерживаемый тип 0x' + b.toString(16));
+    }
+
+    return read();
+  }
+
+  // ---------- таблица очков ----------
+  // Полный список приходит с полем seq (joined, room_attached, ответ на sync),
+  // в рассылках по sonp.msgpack — дельта {base, seq, changed, removed}.
+  // Опоздавшие дельты (seq не больше текущего) отбрасываются. Если снимок в ответ
+  // на sync не пришёл за SYNC_RETRY_MS (например, запрос срезал лимит сервера),
+  // при следующем разрыве sync отправляется снова.
+  const SYNC_RETRY_MS = 3000;
+
+  function ranked(board){
+    return Array.from(board.values())
+      .sort((a, b) => ((b.score || 0) - (a.score || 0)) || ((a.totalTimeMs || 0) - (b.totalTimeMs || 0)));
+  }
+
+  function applyBoard(ws, m){
+    const st = ws._sonpBoard || (ws._sonpBoard = { seq: 0, board: new Map(), syncing: false, syncAt: 0 });
+    ['players', 'scores'].forEach(key => {
+      const v = m[key];
+      if (Array.isArray(v)){
+        if (typeof m.seq === 'number'){
+          st.board = new Map(v.map(p => [p.playerId, p]));
+          st.seq = m.seq;
+          st.syncing = false;
+        }
+        return;
+      }
+      if (!v || typeof v !== 'object' || typeof v.seq !== 'number') return;
+      if (v.seq > st.seq){
+        if (st.syncing && Date.now() - st.syncAt > SYNC_RETRY_MS) st.syncing = false;
+        if (v.base !== st.seq && !st.syncing){
+          st.syncing = true;
+          st.syncAt = Date.now();
+          send(ws, { type: 'sync' });
+        }
+        (v.removed || []).forEach(id => st.board.delete(id));
+        (v.changed || []).forEach(p => st.board.set(p.playerId, p));
+        st.seq = v.seq;
+      }
+      m[key] = ranked(st.board);
+    });
+    return m;
+  }
+
+  // ---------- API ----------
+  function connect(url){
+    const ws = new WebSocket(url, [PROTO_MSGPACK, PROTO_JSON]);
+    ws.binaryType = 'arraybuffer';
+    return ws;
+  }
+
+  function send(ws, msg){
+    if (ws.protocol === PROTO_MSGPACK) ws.send(encode(renameKeys(msg, SHORT)));
+    else ws.send(JSON.stringify(msg));
+  }
+
+  function decodeMessage(ws, data){
+    const m = typeof data === 'string' ? JSON.parse(data) : renameKeys(decode(data), LONG);
+    return applyBoard(ws, m);
+  }
+
+  global.SonpWire = { connect, send, decode: decodeMessage, msgpack: { encode, decode } };
+})(window);